@@ -1,32 +1,53 @@
 import logging
 import uuid
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
-from app.ml_models import ML_MODELS, indexer
-from app.services.search_logic import SearchEngine
+from typing import Any, Dict
+from fastapi import APIRouter, BackgroundTasks, Body, Depends, HTTPException
+from app.ml_models import ML_MODELS
+from app.services.indexer import Indexer
+from app.services.search_logic import BatchedSearcher
 from app.models.search import SearchFilters
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-def get_search_engine() -> SearchEngine:
-    return ML_MODELS["search_engine"]
+def get_search_engine() -> BatchedSearcher:
+    return ML_MODELS["batched_searcher"]
 
-@router.post("/")
-async def search_candidates_endpoint(
-    filters: SearchFilters,
-    engine: SearchEngine = Depends(get_search_engine)
-):
+def get_indexer() -> Indexer:
+    return ML_MODELS["indexer"]
+
+async def _run_search(filters: SearchFilters, engine: BatchedSearcher) -> dict:
     try:
-        logger.info(f"Search request with filters: {filters.model_dump()}")
-        filters_dict = filters.model_dump(exclude_none=True)
+        full_filters = filters.model_dump()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Search request with filters: %s", full_filters)
+        filters_dict = {k: v for k, v in full_filters.items() if v is not None}
         results = await engine.hybrid_search(filters=filters_dict)
         return {"results": results}
     except Exception as e:
         logger.error(f"Error processing search request: {e}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
+@router.post("/")
+async def search_candidates_endpoint(
+    filters: SearchFilters,
+    engine: BatchedSearcher = Depends(get_search_engine)
+):
+    return await _run_search(filters, engine)
+
+@router.post("/raw")
+async def search_candidates_raw_endpoint(
+    body: Dict[str, Any] = Body(...),
+    engine: BatchedSearcher = Depends(get_search_engine)
+):
+    """
+    Поиск для внутренних сервисов: фильтры не валидируются,
+    вызывающая сторона отвечает за их корректность.
+    """
+    return await _run_search(SearchFilters.model_construct(**body), engine)
+
 @router.post("/index/rebuild")
-async def rebuild_index(background_tasks: BackgroundTasks):
+async def rebuild_index(background_tasks: BackgroundTasks, indexer: Indexer = Depends(get_indexer)):
     task_id = str(uuid.uuid4())
     logger.info(f"Starting rebuild with task_id: {task_id}")
     background_tasks.add_task(indexer.run_full_reindex)
@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import field_validator
 from pydantic_settings import BaseSettings
 from dotenv import load_dotenv
@@ -8,22 +9,92 @@ class Settings(BaseSettings):
     """Класс для управления конфигурацией приложения."""
     ELASTICSEARCH_URL: str
     CANDIDATE_API_URL: str
+    CANDIDATE_FETCH_CONCURRENCY: int = 4
+    # "offset" - параллельная загрузка по limit/offset,
+    # "cursor" - последовательная по after=<id> (если API кандидатов его поддерживает).
+    CANDIDATE_PAGINATION: str = "offset"
     RABBITMQ_HOST: str
     RABBITMQ_PORT: int = 5672
     RABBITMQ_USER: str = "guest"
     RABBITMQ_PASS: str = "guest"
+    RABBITMQ_PREFETCH: int = 500
     CANDIDATE_EXCHANGE_NAME: str
+    CONSUMER_FLUSH_INTERVAL_MS: int = 200
     CANDIDATE_ALIAS: str = "candidates"
+    ES_ALIAS_MARKER_PATH: str = "/tmp/.es_alias_ok"
+    ES_ALIAS_RECHECK_TTL: int = 3600
     BATCH_SIZE: int = 500
+    ENCODE_BATCH_SIZE: int = 64
+    # Число процессов для кодирования при переиндексации (0 - кодировать в текущем процессе).
+    ENCODE_PROCESSES: int = 0
+    # Кэш эмбеддингов для переиндексации (None - отключен).
+    EMBEDDING_CACHE_PATH: Optional[str] = "/tmp/.embedding_cache.sqlite3"
+    ES_REFRESH_INTERVAL: str = "1s"
+    ES_NUMBER_OF_REPLICAS: int = 1
+    ES_BULK_CONCURRENCY: int = 8
+    ES_BULK_CHUNK_SIZE: int = 1000
+    ES_BULK_MAX_CHUNK_BYTES: int = 10 * 1024 * 1024
     RRF_K: int = 60
+    QUERY_CACHE_SIZE: int = 10_000
+    QUERY_CACHE_WARMUP_SIZE: int = 100
+    SEARCH_BATCH_WINDOW_MS: int = 5
+    SEARCH_BATCH_MAX_SIZE: int = 64
+    # Процессы с отдельными копиями модели для кодирования запросов (0 - в потоках).
+    QUERY_ENCODE_PROCESSES: int = 0
+    # Кэш результатов поиска и выдачи Elasticsearch (TTL 0 - отключен).
+    SEARCH_CACHE_SIZE: int = 1024
+    SEARCH_CACHE_TTL: int = 60
+    ES_SEARCH_TIMEOUT: float = 2.0
+    # Режим гибридного поиска: "es_prefilter" или "parallel"
+    HYBRID_MODE: str = "es_prefilter"
+    # Сколько кандидатов отбирает Elasticsearch в режиме es_prefilter
+    ES_CANDIDATES_SIZE: int = 500
+    # Глубина выдачи каждой стороны в режиме parallel
+    HYBRID_PARALLEL_SIZE: int = 50
+    # Сколько результатов возвращает гибридный поиск после RRF
+    SEARCH_TOP_K: int = 10
+    # До скольких ID кандидатов фильтровать поиск Milvus выражением "in"
+    MILVUS_EXPR_MAX_IDS: int = 64
+    # Глубина глобального поиска Milvus для пересечения с выдачей Elasticsearch
+    MILVUS_GLOBAL_LIMIT: int = 200
     MILVUS_HOST: str = "localhost"
     MILVUS_PORT: str = "19530"
+    # FLOAT16_VECTOR и BFLOAT16_VECTOR требуют Milvus/pymilvus >= 2.4 (в requirements 2.3.3,
+    # старт с ними завершится ошибкой); тип входит в имя коллекции, после смены нужна переиндексация.
+    MILVUS_VECTOR_TYPE: str = "FLOAT_VECTOR"
+    # GPU-профиль: {"metric_type": "IP", "index_type": "GPU_CAGRA",
+    #   "params": {"intermediate_graph_degree": 64, "graph_degree": 32}}
+    # с MILVUS_SEARCH_PARAMS = {"metric_type": "IP", "params": {"itopk_size": 64}}
     MILVUS_INDEX_PARAMS: dict = {
         "metric_type": "IP",
-        "index_type": "IVF_FLAT",
-        "params": {"nlist": 128}
+        "index_type": "HNSW",
+        "params": {"M": 16, "efConstruction": 200}
     }
+    MILVUS_SEARCH_PARAMS: dict = {
+        "metric_type": "IP",
+        "params": {"ef": 64}
+    }
+    # Дедлайн gRPC-запроса поиска в Milvus, секунды
+    MILVUS_SEARCH_TIMEOUT: float = 2.0
+    # "IVF_FLAT", "IVF_SQ8" или "IVF_PQ" заменяет MILVUS_INDEX_PARAMS пресетом
+    # (IVF_PQ: m должно делить размерность 768). Нужна переиндексация.
+    MILVUS_INDEX_TYPE: Optional[str] = None
+    MILVUS_PQ_M: int = 96
+    MILVUS_PQ_NBITS: int = 8
+    # Ожидаемое число кандидатов: по нему nlist IVF-индекса подбирается при создании
+    MILVUS_EXPECTED_ENTITIES: int = 100000
     SENTENCE_MODEL_NAME: str = "paraphrase-multilingual-mpnet-base-v2"
+    # "torch" или "onnx" (для onnx нужен optimum[onnxruntime]).
+    # Для INT8 на CPU: SENTENCE_MODEL_FILE="onnx/model_qint8_avx512_vnni.onnx"
+    # или SENTENCE_MODEL_QUANTIZATION="avx512_vnni" для автоматического экспорта.
+    SENTENCE_MODEL_BACKEND: str = "torch"
+    SENTENCE_MODEL_FILE: Optional[str] = None
+    SENTENCE_MODEL_QUANTIZATION: Optional[str] = None
+    SENTENCE_MODEL_EXPORT_DIR: str = "models"
+    TORCH_NUM_THREADS: Optional[int] = None
+    # Инференс в FP16, если доступен CUDA (только для backend "torch").
+    SENTENCE_MODEL_GPU_FP16: bool = True
+    WARMUP_ON_START: bool = True
 
     class Config:
         env_file = ".env"
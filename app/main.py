@@ -1,70 +1,130 @@
+import asyncio
 import logging
-from fastapi import FastAPI, HTTPException
+import os
+import time
+import httpx
+import orjson
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
 from contextlib import asynccontextmanager
 from elasticsearch import AsyncElasticsearch
+from elasticsearch.serializer import OrjsonSerializer
 
 from app.api.v1.search import router as search_router
 from app.services.milvus_client import milvus_client
 from app.services.consumer import consumer
 from app.core.config import settings
-from app.services.indexer import CANDIDATE_ALIAS
+from app.services.indexer import Indexer, CANDIDATE_ALIAS, CANDIDATE_INDEX_ANALYSIS, CANDIDATE_INDEX_MAPPINGS
+from app.services.search_logic import SearchEngine, BatchedSearcher
+from app.ml_models import ML_MODELS, SENTENCE_MODEL, create_encode_pool, warm_up_encode_pool
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-async def ensure_es_alias_exists():
+WELCOME_BYTES = orjson.dumps({"message": "Welcome to the Search Service"})
+HEALTHY_BYTES = orjson.dumps({"status": "healthy"})
+
+async def ensure_es_alias_exists(es_client: AsyncElasticsearch):
     """
     Проверяет при старте, существует ли алиас. Если нет, создает
-    пустой индекс и направляет алиас на него.
+    пустой индекс и направляет алиас на него. Успешная проверка
+    запоминается в файле-маркере на ES_ALIAS_RECHECK_TTL секунд.
     """
-    es_client = AsyncElasticsearch(settings.ELASTICSEARCH_URL)
+    marker_path = settings.ES_ALIAS_MARKER_PATH
     try:
-        alias_exists = await es_client.indices.exists_alias(name=CANDIDATE_ALIAS)
-        if not alias_exists:
-            logger.warning(f"Alias '{CANDIDATE_ALIAS}' not found. Creating initial index and alias.")
-            initial_index = f"{CANDIDATE_ALIAS}-initial"
-            
-            if not await es_client.indices.exists(index=initial_index):
-                 await es_client.indices.create(index=initial_index)
+        if time.time() - os.path.getmtime(marker_path) < settings.ES_ALIAS_RECHECK_TTL:
+            logger.info(f"Alias '{CANDIDATE_ALIAS}' was verified recently, skipping check.")
+            return
+    except OSError:
+        pass
+
+    alias_exists = await es_client.indices.exists_alias(name=CANDIDATE_ALIAS)
+    if not alias_exists:
+        logger.warning(f"Alias '{CANDIDATE_ALIAS}' not found. Creating initial index and alias.")
+        initial_index = f"{CANDIDATE_ALIAS}-initial"
 
-            await es_client.indices.put_alias(index=initial_index, name=CANDIDATE_ALIAS)
-            logger.info(f"Successfully created alias '{CANDIDATE_ALIAS}' pointing to '{initial_index}'.")
-    finally:
-        await es_client.close()
+        if not await es_client.indices.exists(index=initial_index):
+            await es_client.indices.create(
+                index=initial_index,
+                settings={"analysis": CANDIDATE_INDEX_ANALYSIS},
+                mappings=CANDIDATE_INDEX_MAPPINGS
+            )
+
+        await es_client.indices.put_alias(index=initial_index, name=CANDIDATE_ALIAS)
+        logger.info(f"Successfully created alias '{CANDIDATE_ALIAS}' pointing to '{initial_index}'.")
+
+    try:
+        with open(marker_path, "a"):
+            os.utime(marker_path)
+    except OSError as e:
+        logger.warning(f"Could not write alias marker '{marker_path}': {e}")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info("Application startup...")
-    await ensure_es_alias_exists()
+    await asyncio.to_thread(SENTENCE_MODEL.load)
+    app.state.es = AsyncElasticsearch(settings.ELASTICSEARCH_URL, connections_per_node=25, serializer=OrjsonSerializer())
+    app.state.http = httpx.AsyncClient(
+        http2=False,
+        trust_env=False,
+        timeout=20.0,
+        limits=httpx.Limits(max_keepalive_connections=16, max_connections=32)
+    )
+    await asyncio.to_thread(milvus_client.connect)
+    await ensure_es_alias_exists(app.state.es)
+
+    app.state.encode_pool = create_encode_pool(settings.QUERY_ENCODE_PROCESSES)
+    if app.state.encode_pool is not None:
+        await asyncio.to_thread(warm_up_encode_pool, app.state.encode_pool, settings.QUERY_ENCODE_PROCESSES)
+    search_engine = await asyncio.to_thread(
+        SearchEngine, model=SENTENCE_MODEL, es_client=app.state.es, encode_pool=app.state.encode_pool
+    )
+    indexer = await asyncio.to_thread(
+        Indexer,
+        model=SENTENCE_MODEL,
+        candidate_api_url=settings.CANDIDATE_API_URL,
+        es_client=app.state.es,
+        http_client=app.state.http
+    )
+    ML_MODELS.update({
+        "search_engine": search_engine,
+        "batched_searcher": BatchedSearcher(engine=search_engine),
+        "indexer": indexer,
+    })
+
+    await search_engine.warm_query_cache()
     await consumer.connect()
-    consumer.start_consuming()
+    await consumer.start_consuming(indexer)
     yield
     logger.info("Application shutdown...")
+    await ML_MODELS["batched_searcher"].close()
     await consumer.close()
+    await ML_MODELS["indexer"].close()
+    await app.state.http.aclose()
+    if app.state.encode_pool is not None:
+        app.state.encode_pool.shutdown(cancel_futures=True)
     milvus_client.disconnect()
+    await app.state.es.close()
 
-app = FastAPI(title="Search Service", lifespan=lifespan)
+app = FastAPI(title="Search Service", lifespan=lifespan, default_response_class=ORJSONResponse)
 
 app.include_router(search_router, prefix="/v1/search")
 
 @app.get("/")
 def read_root():
-    return {"message": "Welcome to the Search Service"}
+    return Response(content=WELCOME_BYTES, media_type="application/json")
 
 @app.get("/health")
-async def health_check():
+async def health_check(request: Request):
     try:
-        es_client = AsyncElasticsearch(settings.ELASTICSEARCH_URL)
-        if not await es_client.ping():
+        if not await request.app.state.es.ping():
             raise Exception("Elasticsearch down")
         if not milvus_client.has_collection():
             raise Exception("Milvus collection missing")
         if not await consumer.check_connection():
             raise Exception("RabbitMQ connection failed")
-        return {"status": "healthy"}
+        return Response(content=HEALTHY_BYTES, media_type="application/json")
     except Exception as e:
         logger.error(f"Health check failed: {e}")
-        raise HTTPException(status_code=503, detail=f"Service unhealthy: {str(e)}")
-    finally:
-        await es_client.close()
\ No newline at end of file
+        raise HTTPException(status_code=503, detail=f"Service unhealthy: {str(e)}")
\ No newline at end of file
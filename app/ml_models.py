@@ -1,41 +1,148 @@
 import logging
-from sentence_transformers import SentenceTransformer
-from app.services.search_logic import SearchEngine
-from app.services.indexer import Indexer
+import multiprocessing
+import os
+import torch
+from concurrent.futures import ProcessPoolExecutor
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
 from app.core.config import settings
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def encode_device() -> str:
+    """Устройство и точность, на которых модель считает эмбеддинги."""
+    if settings.SENTENCE_MODEL_BACKEND == "torch" and torch.cuda.is_available():
+        return "cuda-fp16" if settings.SENTENCE_MODEL_GPU_FP16 else "cuda-fp32"
+    return "cpu-fp32"
+
+
 class LazySentenceTransformer:
     def __init__(self, model_name='paraphrase-multilingual-mpnet-base-v2'):
         self.model_name = getattr(settings, 'SENTENCE_MODEL_NAME', model_name)
         self._model = None
 
+    def _resolve_model_source(self):
+        """
+        Возвращает путь к модели и имя файла графа. Для ONNX с квантизацией
+        INT8-граф экспортируется один раз в SENTENCE_MODEL_EXPORT_DIR.
+        """
+        quantization = settings.SENTENCE_MODEL_QUANTIZATION
+        if settings.SENTENCE_MODEL_BACKEND != "onnx" or not quantization:
+            return self.model_name, settings.SENTENCE_MODEL_FILE
+
+        export_dir = os.path.join(settings.SENTENCE_MODEL_EXPORT_DIR, self.model_name.replace("/", "__"))
+        file_name = f"onnx/model_qint8_{quantization}.onnx"
+        if not os.path.exists(os.path.join(export_dir, file_name)):
+            logger.info(f"Exporting INT8 ONNX model ({quantization}) to '{export_dir}'...")
+            onnx_model = SentenceTransformer(self.model_name, backend="onnx")
+            onnx_model.save(export_dir)
+            export_dynamic_quantized_onnx_model(onnx_model, quantization, export_dir)
+        return export_dir, file_name
+
+    def load(self):
+        """Загружает и прогревает модель, если она еще не загружена."""
+        if self._model is not None:
+            return
+        try:
+            logger.info(f"Loading Sentence Transformer model '{self.model_name}' ({settings.SENTENCE_MODEL_BACKEND})...")
+            torch.set_num_threads(settings.TORCH_NUM_THREADS or os.cpu_count())
+            model_path, file_name = self._resolve_model_source()
+            model_kwargs = {"file_name": file_name} if file_name else None
+            device = "cuda" if encode_device().startswith("cuda") else None
+            self._model = SentenceTransformer(
+                model_path,
+                device=device,
+                backend=settings.SENTENCE_MODEL_BACKEND,
+                model_kwargs=model_kwargs
+            )
+            if encode_device() == "cuda-fp16":
+                # На GPU FP16 задействует тензорные ядра; эмбеддинги все равно
+                # приводятся к float32 перед записью в Milvus.
+                self._model.half()
+                logger.info("Model moved to CUDA in FP16.")
+            if settings.WARMUP_ON_START:
+                self._warm_up()
+                logger.info("Model loaded and warmed up.")
+            else:
+                logger.info("Model loaded.")
+        except Exception as e:
+            logger.error(f"Failed to load model: {e}")
+            raise RuntimeError("Model loading failed")
+
+    def _warm_up(self):
+        """
+        Прогоняет пакет коротких текстов и один длинный, чтобы первый реальный
+        запрос не платил за инициализацию ядер, аллокатора и CUDA-контекста.
+        """
+        self._model.encode(["warmup"] * 8, batch_size=8, normalize_embeddings=True)
+        long_text = " ".join(["warmup"] * (self._model.max_seq_length or 256))
+        self._model.encode([long_text], normalize_embeddings=True)
+
     def __getattr__(self, name):
         if self._model is None:
-            try:
-                logger.info(f"Lazy loading Sentence Transformer model '{self.model_name}'...")
-                self._model = SentenceTransformer(self.model_name)
-                self._model.encode("Dummy text for warm-up.")
-                logger.info("Model loaded and warmed up.")
-            except Exception as e:
-                logger.error(f"Failed to load model: {e}")
-                raise RuntimeError("Model loading failed")
-        return getattr(self._model, name)
+            self.load()
+        attr = getattr(self._model, name)
+        if callable(attr):
+            # Методы модели кэшируются в экземпляре, чтобы повторные обращения
+            # (например, к encode) не проходили через __getattr__.
+            self.__dict__[name] = attr
+        return attr
 
 SENTENCE_MODEL = LazySentenceTransformer()
 
-search_engine_instance = SearchEngine(model=SENTENCE_MODEL)
-indexer_instance = Indexer(
-    model=SENTENCE_MODEL,
-    candidate_api_url=settings.CANDIDATE_API_URL,
-    es_url=settings.ELASTICSEARCH_URL
-)
+_WORKER_MODEL = None
+_WORKER_BARRIER = None
+# Сколько ждать, пока все воркеры пула загрузят модель, секунды.
+POOL_WARMUP_TIMEOUT = 600
+
+
+def _init_encode_worker(barrier=None):
+    """Загружает модель один раз при старте процесса-воркера."""
+    global _WORKER_MODEL, _WORKER_BARRIER
+    _WORKER_BARRIER = barrier
+    _WORKER_MODEL = LazySentenceTransformer()
+    _WORKER_MODEL.load()
+    # Каждый воркер считает в один поток, чтобы процессы не делили ядра.
+    torch.set_num_threads(1)
+
+
+def _encode_in_worker(texts: list):
+    return _WORKER_MODEL.encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+
+
+def _warm_up_worker():
+    # Задача не завершается, пока все воркеры не дойдут до барьера:
+    # так каждая задача прогрева попадает в отдельный процесс.
+    _WORKER_BARRIER.wait(timeout=POOL_WARMUP_TIMEOUT)
+    return os.getpid()
+
+
+def create_encode_pool(processes: int):
+    """Создает пул процессов для кодирования запросов; прогревается через warm_up_encode_pool."""
+    if processes <= 0:
+        return None
+    mp_context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=mp_context,
+        initializer=_init_encode_worker,
+        initargs=(mp_context.Barrier(processes),)
+    )
+
+
+def warm_up_encode_pool(pool: ProcessPoolExecutor, processes: int):
+    """
+    Запускает все процессы пула и ждет загрузки модели в каждом: воркеры
+    ProcessPoolExecutor создаются лениво, и без прогрева модель загружалась бы
+    во время пользовательских запросов.
+    """
+    futures = [pool.submit(_warm_up_worker) for _ in range(processes)]
+    pids = {future.result() for future in futures}
+    logger.info(f"Encode pool warmed up with {len(pids)} worker processes.")
+
 
-ML_MODELS = {
-    "search_engine": search_engine_instance,
-    "indexer": indexer_instance,
-}
+def encode_in_pool(pool: ProcessPoolExecutor, texts: list):
+    return pool.submit(_encode_in_worker, texts).result()
 
-indexer = indexer_instance
\ No newline at end of file
+# Заполняется в lifespan приложения: сервисы создаются поверх общих клиентов.
+ML_MODELS = {}
\ No newline at end of file
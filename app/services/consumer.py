@@ -1,15 +1,17 @@
 import asyncio
-import json
 import aio_pika
+import orjson
 import logging
-from concurrent.futures import ThreadPoolExecutor
 from app.core.config import settings
-from app.ml_models import indexer
 
 logger = logging.getLogger(__name__)
 
 DLX_NAME = f"{settings.CANDIDATE_EXCHANGE_NAME}.dlx"
 DLQ_NAME = f"{settings.CANDIDATE_EXCHANGE_NAME}.dlq"
+FLUSH_BATCH_SIZE = getattr(settings, "BATCH_SIZE", 500)
+PREFETCH_COUNT = getattr(settings, "RABBITMQ_PREFETCH", FLUSH_BATCH_SIZE)
+FLUSH_INTERVAL = getattr(settings, "CONSUMER_FLUSH_INTERVAL_MS", 200) / 1000
+FLUSH_RETRIES = 3
 
 class RabbitMQConsumer:
     def __init__(self):
@@ -20,7 +22,10 @@ class RabbitMQConsumer:
         self.connection = None
         self.channel = None
         self.task = None
-        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.flush_task = None
+        self.indexer = None
+        self._buffer: list[aio_pika.IncomingMessage] = []
+        self._buffer_full = asyncio.Event()
 
     async def check_connection(self):
         try:
@@ -37,7 +42,7 @@ class RabbitMQConsumer:
                 logger.info(f"Connecting to RabbitMQ (attempt {attempt + 1})...")
                 self.connection = await aio_pika.connect_robust(self.connection_string)
                 self.channel = await self.connection.channel()
-                await self.channel.set_qos(prefetch_count=1)
+                await self.channel.set_qos(prefetch_count=PREFETCH_COUNT)
                 logger.info("Successfully connected to RabbitMQ.")
                 return
             except Exception as e:
@@ -46,32 +51,88 @@ class RabbitMQConsumer:
         raise Exception("Failed to connect to RabbitMQ after retries.")
 
     async def on_message(self, message: aio_pika.IncomingMessage):
-        try:
-            routing_key = message.routing_key
-            body = message.body.decode()
-            data = json.loads(body)
+        """
+        Складывает сообщение в буфер; подтверждение выполняется после
+        пакетной записи в Elasticsearch и Milvus.
+        """
+        self._buffer.append(message)
+        if len(self._buffer) >= FLUSH_BATCH_SIZE:
+            self._buffer_full.set()
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._buffer_full.wait(), timeout=FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._buffer_full.clear()
+            try:
+                await self._flush()
+            except Exception as e:
+                logger.error(f"Unexpected error while flushing message batch: {e}")
+
+    async def _flush(self):
+        if not self._buffer:
+            return
+        messages, self._buffer = self._buffer, []
 
-            logger.info(f"Received message with routing key '{routing_key}'")
+        # Для каждого кандидата учитывается только последнее событие в пакете.
+        latest_events = {}
+        to_ack = []
+        for message in messages:
+            routing_key = message.routing_key
+            try:
+                data = orjson.loads(message.body)
+                if not isinstance(data, dict):
+                    raise ValueError("message body is not a JSON object")
+                candidate_id = data.get("id")
+                if candidate_id is not None and not isinstance(candidate_id, (str, int)):
+                    raise ValueError("'id' must be a string or an integer")
+                if routing_key in ["candidate.created", "candidate.updated"]:
+                    if candidate_id is None:
+                        raise ValueError("'id' not found in upsert message")
+                    # Ошибки в данных кандидата должны отклонять только это сообщение, а не весь пакет.
+                    self.indexer._format_candidate_for_es(data)
+                    self.indexer._create_candidate_document_for_ml(data)
+            except Exception as e:
+                logger.error(f"Error decoding message: {e}. Rejecting and sending to DLQ.")
+                await message.reject(requeue=False)
+                continue
 
+            to_ack.append(message)
             if routing_key in ["candidate.created", "candidate.updated"]:
-                await indexer.index_document(data)
-                future = self.executor.submit(indexer.upsert_vector, data)
-                await asyncio.wrap_future(future)
+                latest_events[candidate_id] = ("upsert", data)
             elif routing_key == "candidate.deleted":
-                candidate_id = data.get("id")
                 if candidate_id:
-                    await indexer.delete_document(candidate_id)
-                    future = self.executor.submit(indexer.delete_vector, candidate_id)
-                    await asyncio.wrap_future(future)
+                    latest_events[candidate_id] = ("delete", None)
                 else:
                     logger.error("Error: 'id' not found in delete message")
-            
-            await message.ack()
-            logger.info(f"Message with routing key '{routing_key}' processed successfully.")
 
-        except Exception as e:
-            logger.error(f"Error processing message: {e}. Rejecting and sending to DLQ.")
-            await message.reject(requeue=False)
+        upserts = [data for action, data in latest_events.values() if action == "upsert"]
+        deletes = [candidate_id for candidate_id, (action, _) in latest_events.items() if action == "delete"]
+
+        # Ошибки на этом этапе связаны с инфраструктурой, а не с данными: пакет
+        # повторяется целиком (операции идемпотентны), затем возвращается в очередь.
+        for attempt in range(FLUSH_RETRIES):
+            try:
+                if upserts:
+                    await self.indexer.bulk_index_documents(upserts)
+                    await self.indexer.upsert_vectors(upserts)
+                if deletes:
+                    await self.indexer.bulk_delete_documents(deletes)
+                    await self.indexer.delete_vectors(deletes)
+                break
+            except Exception as e:
+                logger.error(f"Error processing batch (attempt {attempt + 1}/{FLUSH_RETRIES}): {e}")
+                if attempt + 1 < FLUSH_RETRIES:
+                    await asyncio.sleep(2 ** attempt)
+        else:
+            logger.error(f"Requeueing {len(to_ack)} messages after failed batch processing.")
+            await asyncio.gather(*(message.nack(requeue=True) for message in to_ack))
+            return
+
+        await asyncio.gather(*(message.ack() for message in to_ack))
+        logger.info(f"Processed batch of {len(to_ack)} messages ({len(upserts)} upserts, {len(deletes)} deletes).")
 
     async def consume(self):
         if not self.connection:
@@ -100,17 +161,20 @@ class RabbitMQConsumer:
         logger.info("Starting to consume messages with DLQ configured...")
         await queue.consume(self.on_message)
 
-    def start_consuming(self):
-        loop = asyncio.get_event_loop()
-        self.task = loop.create_task(self.consume())
+    async def start_consuming(self, indexer):
+        self.indexer = indexer
+        self.task = asyncio.create_task(self.consume())
+        self.flush_task = asyncio.create_task(self._flush_loop())
         logger.info("RabbitMQ consumer task created.")
 
     async def close(self):
         if self.task and not self.task.done():
             self.task.cancel()
+        if self.flush_task and not self.flush_task.done():
+            self.flush_task.cancel()
+        await self._flush()
         if self.connection:
             await self.connection.close()
-        self.executor.shutdown(wait=True)
         logger.info("RabbitMQ connection closed.")
 
 consumer = RabbitMQConsumer()
\ No newline at end of file
@@ -0,0 +1,72 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """
+    Файловый кэш эмбеддингов кандидатов: candidate_id -> (хеш текста, вектор).
+    Позволяет при переиндексации не кодировать заново неизменившихся кандидатов.
+    """
+    def __init__(self, path: str, namespace: str):
+        self.namespace = hashlib.blake2b(namespace.encode(), digest_size=32).digest()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "candidate_id TEXT PRIMARY KEY, text_hash BLOB NOT NULL, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def text_hash(self, text: str) -> bytes:
+        """Хеш текста документа; пространство имен модели инвалидирует кэш при ее смене."""
+        return hashlib.blake2b(text.encode(), digest_size=8, key=self.namespace).digest()
+
+    def get_many(self, candidate_ids: list) -> dict:
+        if not candidate_ids:
+            return {}
+        placeholders = ",".join("?" * len(candidate_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT candidate_id, text_hash, vector FROM embeddings WHERE candidate_id IN ({placeholders})",
+                [str(candidate_id) for candidate_id in candidate_ids]
+            ).fetchall()
+        return {candidate_id: (text_hash, np.frombuffer(vector, dtype=np.float32)) for candidate_id, text_hash, vector in rows}
+
+    def put_many(self, rows: list):
+        """Сохраняет строки (candidate_id, text_hash, vector)."""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (candidate_id, text_hash, vector) VALUES (?, ?, ?)",
+                [
+                    (str(candidate_id), text_hash, np.ascontiguousarray(vector, dtype=np.float32).tobytes())
+                    for candidate_id, text_hash, vector in rows
+                ]
+            )
+            self._conn.commit()
+
+    def retain(self, candidate_ids):
+        """Удаляет векторы кандидатов, которых нет среди candidate_ids."""
+        with self._lock:
+            self._conn.execute("CREATE TEMP TABLE IF NOT EXISTS retained (candidate_id TEXT PRIMARY KEY)")
+            self._conn.execute("DELETE FROM retained")
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO retained (candidate_id) VALUES (?)",
+                ((str(candidate_id),) for candidate_id in candidate_ids)
+            )
+            deleted = self._conn.execute(
+                "DELETE FROM embeddings WHERE candidate_id NOT IN (SELECT candidate_id FROM retained)"
+            ).rowcount
+            self._conn.execute("DELETE FROM retained")
+            self._conn.commit()
+        logger.info(f"Pruned {deleted} stale embeddings from cache.")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
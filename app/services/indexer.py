@@ -1,32 +1,91 @@
 import asyncio
 import time
+from collections import deque
 import httpx
 import logging
+import numpy as np
+import orjson
 from tenacity import retry, stop_after_attempt, wait_exponential
 from elasticsearch import AsyncElasticsearch, NotFoundError, helpers
 from sentence_transformers import SentenceTransformer
-from pymilvus import utility
 
 from app.core.config import settings
-from app.services.milvus_client import milvus_client, COLLECTION_NAME
+from app.services.milvus_client import milvus_client, candidate_pk, to_milvus_ids, to_milvus_vectors, DIMENSION, REINDEX_PARTITION_PREFIX
+from app.services.embedding_cache import EmbeddingCache
+from app.ml_models import encode_device
 
 logger = logging.getLogger(__name__)
 
 CANDIDATE_ALIAS = getattr(settings, 'CANDIDATE_ALIAS', 'candidates')
 BATCH_SIZE = getattr(settings, "BATCH_SIZE", 500)
+ENCODE_BATCH_SIZE = getattr(settings, "ENCODE_BATCH_SIZE", 64)
+ENCODE_PROCESSES = getattr(settings, "ENCODE_PROCESSES", 0)
+EMBEDDING_CACHE_PATH = getattr(settings, "EMBEDDING_CACHE_PATH", None)
+FETCH_CONCURRENCY = getattr(settings, "CANDIDATE_FETCH_CONCURRENCY", 4)
+CANDIDATE_PAGINATION = getattr(settings, "CANDIDATE_PAGINATION", "offset")
+ES_REFRESH_INTERVAL = getattr(settings, "ES_REFRESH_INTERVAL", "1s")
+ES_NUMBER_OF_REPLICAS = getattr(settings, "ES_NUMBER_OF_REPLICAS", 1)
+ES_BULK_CONCURRENCY = getattr(settings, "ES_BULK_CONCURRENCY", 8)
+ES_BULK_CHUNK_SIZE = getattr(settings, "ES_BULK_CHUNK_SIZE", 1000)
+ES_BULK_MAX_CHUNK_BYTES = getattr(settings, "ES_BULK_MAX_CHUNK_BYTES", 10 * 1024 * 1024)
+PROGRESS_LOG_INTERVAL = 5.0
+
+# Нормализатор приводит keyword-значения к нижнему регистру и обрезает пробелы
+# один раз при индексации и для term-запросов, поэтому в Python они не меняются.
+CANDIDATE_INDEX_ANALYSIS = {
+    "normalizer": {
+        "lc": {"type": "custom", "filter": ["lowercase", "trim"]}
+    }
+}
+
+# Поля точных фильтров хранятся как keyword: фильтрация идет через term/terms
+# в filter-контексте без анализатора и скоринга.
+CANDIDATE_INDEX_MAPPINGS = {
+    "properties": {
+        "id": {"type": "keyword"},
+        "telegram_id": {"type": "long"},
+        "headline_role": {
+            "type": "text",
+            "fields": {"keyword": {"type": "keyword", "ignore_above": 256}}
+        },
+        "experience_years": {"type": "float"},
+        "location": {"type": "keyword", "normalizer": "lc"},
+        "work_modes": {"type": "keyword"},
+        "skills": {"type": "keyword", "normalizer": "lc"},
+        "milvus_pk": {"type": "long"},
+    }
+}
 
 class Indexer:
-    def __init__(self, model: SentenceTransformer, candidate_api_url: str, es_url: str):
-        self.es_client = AsyncElasticsearch(es_url)
+    def __init__(
+        self,
+        model: SentenceTransformer,
+        candidate_api_url: str,
+        es_client: AsyncElasticsearch,
+        http_client: httpx.AsyncClient
+    ):
+        self.es_client = es_client
         self.candidate_api_url = candidate_api_url
+        self._http = http_client
         self.milvus_collection = milvus_client.create_collection_if_not_exists()
+        self.milvus_partition = milvus_client.active_partition(self.milvus_collection)
         self.model = model
-        self.executor = asyncio.get_event_loop().run_in_executor
+        self.embedding_cache = None
+        if EMBEDDING_CACHE_PATH:
+            namespace = "|".join(str(part) for part in (
+                settings.SENTENCE_MODEL_NAME,
+                settings.SENTENCE_MODEL_BACKEND,
+                settings.SENTENCE_MODEL_FILE,
+                settings.SENTENCE_MODEL_QUANTIZATION,
+                encode_device(),
+                "normalized",
+            ))
+            self.embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, namespace)
 
     def _format_candidate_for_es(self, candidate: dict) -> dict:
         if "id" not in candidate:  # IMPROVED: Валидация
             raise ValueError("Candidate data missing 'id'")
-        skills_list = [skill["skill"].lower() for skill in candidate.get("skills", [])]
+        skills_list = [skill["skill"] for skill in candidate.get("skills", [])]
         work_modes_list = candidate.get("work_modes", [])
 
         return {
@@ -37,22 +96,31 @@ class Indexer:
             "location": candidate.get("location"),
             "work_modes": work_modes_list,
             "skills": skills_list,
+            "milvus_pk": candidate_pk(candidate["id"]),
         }
 
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=4, max=10))
-    async def _get_candidates_batch(self, limit: int, offset: int) -> list:
-        url = f"{self.candidate_api_url}/candidates/?limit={limit}&offset={offset}"
-        async with httpx.AsyncClient(http2=False, trust_env=False, timeout=20.0) as client:
-            try:
-                response = await client.get(url)
-                response.raise_for_status()
-                return response.json()
-            except httpx.RequestError as e:
-                logger.error(f"Error fetching candidates batch: {e}")
-                raise
-            except httpx.HTTPStatusError as e:
-                logger.error(f"Error response {e.response.status_code}: {e.response.text}")
-                raise
+    async def _get_candidates_batch(self, limit: int, offset: int = None, after: str = None) -> list:
+        params = {"limit": limit}
+        if after is not None:
+            params["after"] = after
+        else:
+            params["offset"] = offset or 0
+        try:
+            response = await self._http.get(f"{self.candidate_api_url}/candidates/", params=params)
+            response.raise_for_status()
+            return response.json()
+        except httpx.RequestError as e:
+            logger.error(f"Error fetching candidates batch: {e}")
+            raise
+        except httpx.HTTPStatusError as e:
+            logger.error(f"Error response {e.response.status_code}: {e.response.text}")
+            raise
+
+    async def close(self):
+        """Закрывает кэш эмбеддингов; общие клиенты закрывает lifespan."""
+        if self.embedding_cache is not None:
+            self.embedding_cache.close()
 
     def _create_candidate_document_for_ml(self, candidate: dict) -> str:
         """Создает структурированный документ с префиксами для лучшего понимания моделью."""
@@ -74,46 +142,205 @@ class Indexer:
 
         return ". ".join(filter(None, text_parts)) + "."
 
-    def _create_es_actions(self, candidates: list, index_name: str):
+    def _encode_documents(self, texts: list, pool: dict = None):
+        """
+        Кодирует пакет документов одним вызовом: SentenceTransformer сортирует
+        тексты по длине внутри вызова, поэтому мини-батчи почти не содержат паддинга.
+        Векторы нормализуются, так что метрика IP в Milvus равна косинусной близости.
+        """
+        if pool is not None:
+            return self.model.encode_multi_process(
+                texts, pool, batch_size=ENCODE_BATCH_SIZE, normalize_embeddings=True
+            )
+        return self.model.encode(
+            texts,
+            batch_size=ENCODE_BATCH_SIZE,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False
+        )
+
+    def _encode_candidates(self, candidates: list, pool: dict = None):
+        """
+        Кодирует документы кандидатов, переиспользуя векторы из кэша
+        для тех, чей текст не изменился с прошлой переиндексации.
+        """
+        texts = [self._create_candidate_document_for_ml(c) for c in candidates]
+        if self.embedding_cache is None:
+            return self._encode_documents(texts, pool)
+
+        hashes = [self.embedding_cache.text_hash(text) for text in texts]
+        cached = self.embedding_cache.get_many([c["id"] for c in candidates])
+        vectors = np.empty((len(candidates), DIMENSION), dtype=np.float32)
+        missing = []
+        for i, candidate in enumerate(candidates):
+            hit = cached.get(str(candidate["id"]))
+            if hit is not None and hit[0] == hashes[i]:
+                vectors[i] = hit[1]
+            else:
+                missing.append(i)
+
+        if missing:
+            vectors[missing] = self._encode_documents([texts[i] for i in missing], pool)
+            self.embedding_cache.put_many([(candidates[i]["id"], hashes[i], vectors[i]) for i in missing])
+        logger.debug(f"Embedding cache: {len(candidates) - len(missing)} hits, {len(missing)} encoded")
+        return vectors
+
+    def _build_bulk_body(self, candidates: list, index_name: str) -> bytes:
+        """Сериализует кандидатов сразу в NDJSON-тело bulk-запроса."""
+        lines = []
         for candidate in candidates:
-            source_data = self._format_candidate_for_es(candidate)
-            yield {"_index": index_name, "_id": candidate["id"], "_source": source_data}
+            lines.append(orjson.dumps({"index": {"_index": index_name, "_id": candidate["id"]}}))
+            lines.append(orjson.dumps(self._format_candidate_for_es(candidate)))
+        lines.append(b"")
+        return b"\n".join(lines)
 
-    async def index_document(self, candidate_data: dict):
-        doc_id = candidate_data["id"]
-        body = self._format_candidate_for_es(candidate_data)
-        await self.es_client.index(index=CANDIDATE_ALIAS, id=doc_id, document=body)
-        logger.info(f"Indexed/Updated document with ID: {doc_id} via alias")
+    async def _send_bulk(self, body: bytes) -> tuple:
+        """Отправляет готовое тело bulk-запроса и возвращает число успешных операций и ошибки."""
+        response = await self.es_client.bulk(operations=body)
+        items = response["items"]
+        if not response["errors"]:
+            return len(items), []
+        errors = [item for item in items if next(iter(item.values())).get("status", 500) >= 300]
+        return len(items) - len(errors), errors
 
-    async def delete_document(self, candidate_id: str):
+    async def _bulk_index_worker(self, queue: asyncio.Queue, index_name: str) -> tuple:
+        """
+        Индексирует кандидатов из очереди bulk-запросами, объединяя уже готовые
+        страницы, пока запрос не превысит ES_BULK_CHUNK_SIZE документов или
+        ES_BULK_MAX_CHUNK_BYTES байт; несколько таких воркеров параллельно
+        нагружают Elasticsearch. Возвращает число проиндексированных документов и ошибки.
+        """
+        indexed = 0
+        failed = []
+        finished = False
         try:
-            await self.es_client.delete_by_query(index=CANDIDATE_ALIAS, query={"term": {"_id": candidate_id}})
-            logger.info(f"Deleted document with ID: {candidate_id} via alias")
-        except Exception as e:
-            logger.error(f"Could not delete document {candidate_id}: {e}")
+            while not finished:
+                candidates = await queue.get()
+                if candidates is None:
+                    break
+                bodies = [self._build_bulk_body(candidates, index_name)]
+                docs, size = len(candidates), len(bodies[0])
+                while docs < ES_BULK_CHUNK_SIZE and size < ES_BULK_MAX_CHUNK_BYTES and not queue.empty():
+                    candidates = queue.get_nowait()
+                    if candidates is None:
+                        finished = True
+                        break
+                    bodies.append(self._build_bulk_body(candidates, index_name))
+                    docs += len(candidates)
+                    size += len(bodies[-1])
+
+                success, errors = await self._send_bulk(b"".join(bodies))
+                indexed += success
+                for error in errors:
+                    logger.error(f"Failed to index document: {error}")
+                failed.extend(errors)
+        except Exception:
+            # Дочитываем очередь, чтобы не заблокировать основной цикл переиндексации.
+            while not finished and await queue.get() is not None:
+                pass
+            raise
+        return indexed, failed
+
+    async def bulk_index_documents(self, candidates: list):
+        success, errors = await self._send_bulk(self._build_bulk_body(candidates, CANDIDATE_ALIAS))
+        if errors:
+            raise helpers.BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
+        logger.info(f"Bulk indexed {success} documents via alias")
+
+    async def bulk_delete_documents(self, candidate_ids: list):
+        actions = (
+            {"_op_type": "delete", "_index": CANDIDATE_ALIAS, "_id": candidate_id}
+            for candidate_id in candidate_ids
+        )
+        success, _ = await helpers.async_bulk(self.es_client, actions, ignore_status=(404,))
+        logger.info(f"Bulk deleted {success} documents via alias")
+
+    async def upsert_vectors(self, candidates: list):
+        doc_ids = to_milvus_ids(c["id"] for c in candidates)
+        texts = [self._create_candidate_document_for_ml(c) for c in candidates]
+        vectors = await asyncio.to_thread(self._encode_documents, texts)
+        await asyncio.to_thread(
+            self.milvus_collection.upsert, [doc_ids, to_milvus_vectors(vectors)], partition_name=self.milvus_partition
+        )
+        logger.info(f"Upserted {len(doc_ids)} vectors")
+
+    async def delete_vectors(self, candidate_ids: list):
+        expr = f"candidate_id in {to_milvus_ids(candidate_ids)}"
+        await asyncio.to_thread(self.milvus_collection.delete, expr)
+        logger.info(f"Deleted {len(candidate_ids)} vectors")
+
+    async def _fetch_stage(self, fetch_queue: asyncio.Queue):
+        """
+        Загружает страницы кандидатов, держа в полете до FETCH_CONCURRENCY
+        запросов, и передает их дальше строго по порядку смещений.
+        """
+        if CANDIDATE_PAGINATION == "cursor":
+            await self._fetch_stage_cursor(fetch_queue)
+            return
 
-    async def upsert_vector(self, candidate_data: dict):
+        offset = 0
+        in_flight = deque()
         try:
-            doc_id = candidate_data["id"]
-            text_doc = self._create_candidate_document_for_ml(candidate_data)
-            vector = await self.executor(None, self.model.encode, text_doc)
-            exists = self.milvus_collection.query(expr=f'candidate_id == "{doc_id}"', output_fields=["candidate_id"])
-            if exists:
-                logger.info(f"Updating existing vector for {doc_id}")
-            await self.executor(None, self.milvus_collection.upsert, [[doc_id], [vector.tolist()]])
-            self.milvus_collection.flush()
-            logger.info(f"Upserted vector for ID: {doc_id}")
-        except Exception as e:
-            logger.error(f"Could not upsert vector for {doc_id}: {e}")
-
-    async def delete_vector(self, candidate_id: str):
+            while True:
+                while len(in_flight) < FETCH_CONCURRENCY:
+                    in_flight.append(asyncio.create_task(self._get_candidates_batch(limit=BATCH_SIZE, offset=offset)))
+                    offset += BATCH_SIZE
+                candidates_batch = await in_flight.popleft()
+                if not candidates_batch:
+                    break
+                await fetch_queue.put(candidates_batch)
+        finally:
+            for task in in_flight:
+                task.cancel()
+        await fetch_queue.put(None)
+
+    async def _fetch_stage_cursor(self, fetch_queue: asyncio.Queue):
+        """
+        Загружает страницы по курсору (after=<id последнего кандидата>):
+        стоимость страницы не растет с глубиной, но запросы идут по одному.
+        """
+        after = None
+        while candidates_batch := await self._get_candidates_batch(limit=BATCH_SIZE, after=after):
+            await fetch_queue.put(candidates_batch)
+            after = candidates_batch[-1]["id"]
+        await fetch_queue.put(None)
+
+    async def _encode_stage(self, fetch_queue: asyncio.Queue, encode_queue: asyncio.Queue):
+        # Пул процессов нужен только на время переиндексации: каждый воркер
+        # держит свою копию модели.
+        pool = None
+        if ENCODE_PROCESSES > 0:
+            pool = await asyncio.to_thread(self.model.start_multi_process_pool, ["cpu"] * ENCODE_PROCESSES)
         try:
-            expr = f'candidate_id in ["{candidate_id}"]'
-            await self.executor(None, self.milvus_collection.delete, expr)
-            self.milvus_collection.flush()
-            logger.info(f"Deleted vector with ID: {candidate_id}")
-        except Exception as e:
-            logger.error(f"Could not delete vector {candidate_id}: {e}")
+            while (candidates_batch := await fetch_queue.get()) is not None:
+                vectors = await asyncio.to_thread(self._encode_candidates, candidates_batch, pool)
+                await encode_queue.put((candidates_batch, vectors))
+        finally:
+            if pool is not None:
+                await asyncio.to_thread(self.model.stop_multi_process_pool, pool)
+        await encode_queue.put(None)
+
+    async def _store_stage(self, encode_queue: asyncio.Queue, es_queue: asyncio.Queue, partition_name: str):
+        stored_ids = set()
+        last_log_at = time.monotonic()
+        while (item := await encode_queue.get()) is not None:
+            candidates_batch, vectors = item
+
+            milvus_ids = to_milvus_ids(c['id'] for c in candidates_batch)
+            await asyncio.gather(
+                es_queue.put(candidates_batch),
+                asyncio.to_thread(
+                    milvus_client.insert_vectors, self.milvus_collection, milvus_ids, to_milvus_vectors(vectors), partition_name
+                )
+            )
+
+            stored_ids.update(c['id'] for c in candidates_batch)
+            if time.monotonic() - last_log_at >= PROGRESS_LOG_INTERVAL:
+                logger.info(f"Reindex progress: {len(stored_ids)} candidates stored so far")
+                last_log_at = time.monotonic()
+        logger.info(f"Stored {len(stored_ids)} candidates in total")
+        return stored_ids
 
     async def run_full_reindex(self):
         """
@@ -121,49 +348,98 @@ class Indexer:
         """
         logger.info("Starting zero-downtime re-indexation process...")
         
-        new_index_name = f"{CANDIDATE_ALIAS}-{int(time.time())}"
+        started_at = int(time.time())
+        new_index_name = f"{CANDIDATE_ALIAS}-{started_at}"
         logger.info(f"Creating new index: {new_index_name}")
-        await self.es_client.indices.create(index=new_index_name)
+        await self.es_client.indices.create(
+            index=new_index_name,
+            settings={
+                "index": {
+                    "refresh_interval": "-1",
+                    "number_of_replicas": 0,
+                    "translog.durability": "async",
+                    "translog.flush_threshold_size": "1gb"
+                },
+                "analysis": CANDIDATE_INDEX_ANALYSIS
+            },
+            mappings=CANDIDATE_INDEX_MAPPINGS
+        )
 
-        offset = 0
-        total_indexed = 0
-        while True:
-            candidates_batch = await self._get_candidates_batch(limit=BATCH_SIZE, offset=offset)
-            if not candidates_batch:
-                break
-            
-            texts_for_ml = [self._create_candidate_document_for_ml(c) for c in candidates_batch]
-            vectors = await self.executor(None, self.model.encode, texts_for_ml)
-            
-            es_actions = self._create_es_actions(candidates_batch, new_index_name)
-            es_success, es_failed = await helpers.async_bulk(self.es_client, es_actions)
+        es_queue = asyncio.Queue(maxsize=ES_BULK_CONCURRENCY * 2)
+        es_workers = [
+            asyncio.create_task(self._bulk_index_worker(es_queue, new_index_name))
+            for _ in range(ES_BULK_CONCURRENCY)
+        ]
 
-            if offset == 0:
-                 if milvus_client.has_collection():
-                    utility.drop_collection(COLLECTION_NAME)
-                 self.milvus_collection = milvus_client.create_collection_if_not_exists()
-            
-            milvus_ids = [c['id'] for c in candidates_batch]
-            await self.executor(None, milvus_client.insert_vectors, self.milvus_collection, milvus_ids, list(vectors))
+        # Векторы пишутся в новую партицию; поиск продолжает работать
+        # по старой, пока загрузка не завершится.
+        new_partition = f"{REINDEX_PARTITION_PREFIX}{started_at}"
+        await asyncio.to_thread(self.milvus_collection.create_partition, new_partition)
 
-            total_indexed += es_success
-            offset += BATCH_SIZE
-            logger.info(f"Batch processed. Total indexed so far: {total_indexed}")
+        fetch_queue = asyncio.Queue(maxsize=2)
+        encode_queue = asyncio.Queue(maxsize=2)
+        stages = [
+            asyncio.create_task(self._fetch_stage(fetch_queue)),
+            asyncio.create_task(self._encode_stage(fetch_queue, encode_queue)),
+            asyncio.create_task(self._store_stage(encode_queue, es_queue, new_partition)),
+        ]
+        try:
+            _, _, stored_ids = await asyncio.gather(*stages)
 
-        logger.info(f"Successfully indexed {total_indexed} documents into '{new_index_name}'.")
+            for _ in es_workers:
+                await es_queue.put(None)
+            worker_results = await asyncio.gather(*es_workers)
+            total_indexed = sum(indexed for indexed, _ in worker_results)
+            errors = [error for _, failed in worker_results for error in failed]
+            if errors:
+                # Неполный индекс не должен заменить рабочий.
+                raise helpers.BulkIndexError(f"{len(errors)} document(s) failed to index.", errors)
 
-        logger.info(f"Switching alias '{CANDIDATE_ALIAS}' to point to '{new_index_name}'")
-        try:
-            old_indices = await self.es_client.indices.get_alias(name=CANDIDATE_ALIAS)
-        except NotFoundError:
-            old_indices = {}
+            logger.info(f"Successfully indexed {total_indexed} documents into '{new_index_name}'.")
 
-        actions = {"actions": [{"add": {"index": new_index_name, "alias": CANDIDATE_ALIAS}}]}
-        for old_index in old_indices.keys():
-            actions["actions"].append({"remove": {"index": old_index, "alias": CANDIDATE_ALIAS}})
-        
-        await self.es_client.indices.update_aliases(body=actions)
-        logger.info("Alias switched successfully.")
+            logger.info(f"Restoring serving settings for '{new_index_name}'...")
+            await self.es_client.indices.put_settings(
+                index=new_index_name,
+                settings={
+                    "index": {
+                        "refresh_interval": ES_REFRESH_INTERVAL,
+                        "number_of_replicas": ES_NUMBER_OF_REPLICAS,
+                        "translog.durability": "request"
+                    }
+                }
+            )
+            # Слияние сегментов большого индекса идет дольше стандартного таймаута клиента.
+            await self.es_client.options(request_timeout=None).indices.forcemerge(
+                index=new_index_name, max_num_segments=1
+            )
+            await self.es_client.indices.refresh(index=new_index_name)
+            # Один flush и compact на всю загрузку вместо запечатывания сегментов на каждом пакете.
+            await asyncio.to_thread(milvus_client.finalize, self.milvus_collection)
+
+            logger.info(f"Switching alias '{CANDIDATE_ALIAS}' to point to '{new_index_name}'")
+            try:
+                old_indices = await self.es_client.indices.get_alias(name=CANDIDATE_ALIAS)
+            except NotFoundError:
+                old_indices = {}
+
+            actions = {"actions": [{"add": {"index": new_index_name, "alias": CANDIDATE_ALIAS}}]}
+            for old_index in old_indices.keys():
+                actions["actions"].append({"remove": {"index": old_index, "alias": CANDIDATE_ALIAS}})
+
+            await self.es_client.indices.update_aliases(body=actions)
+            logger.info("Alias switched successfully.")
+        except BaseException as e:
+            logger.error(f"Re-indexation failed, removing '{new_index_name}' and partition '{new_partition}': {e!r}")
+            for task in stages + es_workers:
+                task.cancel()
+            await self.es_client.indices.delete(index=new_index_name, ignore_unavailable=True)
+            await asyncio.to_thread(milvus_client.drop_partition, self.milvus_collection, new_partition)
+            raise
+
+        self.milvus_partition = new_partition
+        await asyncio.to_thread(milvus_client.drop_stale_partitions, self.milvus_collection, new_partition)
+        if self.embedding_cache is not None:
+            await asyncio.to_thread(self.embedding_cache.retain, stored_ids)
 
         for old_index in old_indices.keys():
             logger.info(f"Deleting old index: {old_index}")
@@ -1,27 +1,116 @@
+import hashlib
 import logging
+import math
+import numpy as np
+from typing import Sequence
 from tenacity import retry, stop_after_attempt, wait_exponential
 from pymilvus import (
-    MilvusException, connections, utility,
+    connections, utility,
     Collection, CollectionSchema, FieldSchema, DataType
 )
 from app.core.config import settings
 
 logger = logging.getLogger(__name__)
 
-COLLECTION_NAME = "candidates_embeddings"
+LEGACY_COLLECTION_NAME = "candidates_embeddings"
+# Версия схемы (INT64-ключ) и тип вектора входят в имя коллекции: при их смене
+# создается новая пустая коллекция, которую заполняет переиндексация.
+SCHEMA_VERSION = 2
+DEFAULT_PARTITION = "_default"
+REINDEX_PARTITION_PREFIX = "p_"
 DIMENSION = 768
+VECTOR_TYPE = getattr(settings, 'MILVUS_VECTOR_TYPE', 'FLOAT_VECTOR')
+COLLECTION_NAME = f"{LEGACY_COLLECTION_NAME}_v{SCHEMA_VERSION}_{VECTOR_TYPE.lower()}"
+VECTOR_NUMPY_DTYPES = {
+    "FLOAT_VECTOR": np.float32,
+    "FLOAT16_VECTOR": np.float16,
+    # В NumPy нет bfloat16: храним битовое представление в uint16.
+    "BFLOAT16_VECTOR": np.uint16,
+}
+if VECTOR_TYPE not in VECTOR_NUMPY_DTYPES or not hasattr(DataType, VECTOR_TYPE):
+    # FLOAT16_VECTOR и BFLOAT16_VECTOR появились только в pymilvus 2.4.
+    raise RuntimeError(
+        f"MILVUS_VECTOR_TYPE={VECTOR_TYPE!r} is not supported by the installed pymilvus; "
+        f"use FLOAT_VECTOR or upgrade pymilvus to >= 2.4 for half-precision vectors."
+    )
 HOST = getattr(settings, 'MILVUS_HOST', 'localhost')
 PORT = getattr(settings, 'MILVUS_PORT', '19530')
 INDEX_PARAMS = getattr(settings, 'MILVUS_INDEX_PARAMS', {
     "metric_type": "IP",
-    "index_type": "IVF_FLAT",
-    "params": {"nlist": 128}
+    "index_type": "HNSW",
+    "params": {"M": 16, "efConstruction": 200}
 })
+# Пресеты квантованных IVF-индексов; nlist подбирается по размеру коллекции.
+INDEX_TYPE = getattr(settings, 'MILVUS_INDEX_TYPE', None)
+if INDEX_TYPE:
+    INDEX_PARAMS = {
+        "metric_type": INDEX_PARAMS.get("metric_type", "IP"),
+        "index_type": INDEX_TYPE,
+        "params": {"m": settings.MILVUS_PQ_M, "nbits": settings.MILVUS_PQ_NBITS} if INDEX_TYPE == "IVF_PQ" else {}
+    }
+EXPECTED_ENTITIES = getattr(settings, 'MILVUS_EXPECTED_ENTITIES', 100000)
+SEARCH_PARAMS = getattr(settings, 'MILVUS_SEARCH_PARAMS', {
+    "metric_type": "IP",
+    "params": {"ef": 64}
+})
+# Параметры поиска, подобранные под текущий индекс (например, nprobe для IVF).
+SEARCH_TUNING: dict = {}
+
+
+def _is_ivf_index(index_params: dict) -> bool:
+    return index_params.get("index_type", "").upper().startswith("IVF")
+
+
+def _remember_nprobe(nlist: int):
+    SEARCH_TUNING["nprobe"] = min(nlist, max(16, int(math.sqrt(nlist))))
+
+
+def candidate_pk(candidate_id: str) -> int:
+    """Переводит UUID кандидата в целочисленный первичный ключ Milvus (64-битный хеш)."""
+    digest = hashlib.blake2b(str(candidate_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def to_milvus_ids(candidate_ids) -> list:
+    return [candidate_pk(candidate_id) for candidate_id in candidate_ids]
+
+
+def float32_to_bfloat16_bits(vectors) -> np.ndarray:
+    """Округляет float32 до bfloat16 (к ближайшему четному) и возвращает биты как uint16."""
+    bits = np.ascontiguousarray(vectors, dtype=np.float32).view(np.uint32)
+    rounded = bits + np.uint32(0x7FFF) + ((bits >> 16) & np.uint32(1))
+    return (rounded >> 16).astype(np.uint16)
+
+
+def to_milvus_vectors(vectors):
+    """
+    Приводит эмбеддинги к непрерывной матрице (N, DIMENSION) с типом
+    векторного поля коллекции; если тип уже совпадает, копирования нет.
+    Для BFLOAT16_VECTOR pymilvus принимает векторы как байты, поэтому
+    возвращается список байтовых строк.
+    """
+    if VECTOR_TYPE == "BFLOAT16_VECTOR":
+        bits = float32_to_bfloat16_bits(np.reshape(vectors, (-1, DIMENSION)))
+        return [row.tobytes() for row in bits]
+    return np.ascontiguousarray(vectors, dtype=VECTOR_NUMPY_DTYPES[VECTOR_TYPE]).reshape(-1, DIMENSION)
+
+
+def get_search_params(limit: int = None) -> dict:
+    """
+    Возвращает параметры поиска с учетом подобранных под индекс значений.
+    Для HNSW Milvus требует ef >= limit, поэтому ef поднимается до limit.
+    """
+    params = {**SEARCH_PARAMS.get("params", {}), **SEARCH_TUNING}
+    if limit is not None and "ef" in params and params["ef"] < limit:
+        params["ef"] = limit
+    return {**SEARCH_PARAMS, "params": params}
 
 class MilvusClient:
     def __init__(self, host=HOST, port=PORT):
         self.host = host
         self.port = port
+
+    def connect(self):
         self._connect_with_retry()
 
     @retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=1, min=4, max=10))
@@ -36,25 +125,41 @@ class MilvusClient:
     def has_collection(self):
         return utility.has_collection(COLLECTION_NAME)
 
+    def _build_schema(self) -> CollectionSchema:
+        candidate_id = FieldSchema(name="candidate_id", dtype=DataType.INT64, is_primary=True)
+        embedding = FieldSchema(name="embedding", dtype=getattr(DataType, VECTOR_TYPE), dim=DIMENSION)
+        return CollectionSchema(fields=[candidate_id, embedding], description="Candidate profile embeddings")
+
     def create_collection_if_not_exists(self):
+        schema = self._build_schema()
+        expected_types = {field.name: field.dtype for field in schema.fields}
         if self.has_collection():
             logger.info(f"Collection '{COLLECTION_NAME}' already exists.")
             collection = Collection(COLLECTION_NAME)
+            if {field.name: field.dtype for field in collection.schema.fields} != expected_types:
+                raise RuntimeError(
+                    f"Collection '{COLLECTION_NAME}' does not match the expected schema. "
+                    f"Drop it manually and run a full re-indexation."
+                )
         else:
-            candidate_id = FieldSchema(name="candidate_id", dtype=DataType.VARCHAR, is_primary=True, max_length=36)
-            embedding = FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR, dim=DIMENSION)
-
-            schema = CollectionSchema(fields=[candidate_id, embedding], description="Candidate profile embeddings")
             collection = Collection(name=COLLECTION_NAME, schema=schema)
             logger.info(f"Created new collection '{COLLECTION_NAME}'.")
+            if utility.has_collection(LEGACY_COLLECTION_NAME):
+                logger.warning(
+                    f"Legacy collection '{LEGACY_COLLECTION_NAME}' is not used anymore: "
+                    f"run a full re-indexation to fill '{COLLECTION_NAME}', then drop it manually."
+                )
 
         try:
             if not collection.indexes:
                 logger.warning(f"No index found for collection '{COLLECTION_NAME}'. Creating one...")
-                collection.create_index(field_name="embedding", index_params=INDEX_PARAMS)
+                collection.create_index(field_name="embedding", index_params=self._index_params_for(collection))
                 logger.info("Index created for embedding field.")
             else:
                 logger.info(f"Index already exists for collection '{COLLECTION_NAME}'.")
+                existing_params = collection.indexes[0].params
+                if _is_ivf_index(existing_params):
+                    _remember_nprobe(existing_params.get("params", {}).get("nlist", 128))
 
             collection.load()
             logger.info(f"Collection '{COLLECTION_NAME}' loaded after creation/check.")
@@ -64,30 +169,66 @@ class MilvusClient:
 
         return collection
 
-    def insert_vectors(self, collection: Collection, ids: list, vectors: list):
-        if not ids or not vectors:
+    def _index_params_for(self, collection: Collection) -> dict:
+        """
+        Для IVF-индексов подбирает nlist ≈ 4·sqrt(N), где N — большее из размера
+        коллекции и MILVUS_EXPECTED_ENTITIES: индекс создается на пустой
+        коллекции и не должен перестраиваться после каждой загрузки.
+        """
+        if not _is_ivf_index(INDEX_PARAMS):
+            return INDEX_PARAMS
+        nlist = max(128, int(4 * math.sqrt(max(collection.num_entities, EXPECTED_ENTITIES))))
+        _remember_nprobe(nlist)
+        return {**INDEX_PARAMS, "params": {**INDEX_PARAMS.get("params", {}), "nlist": nlist}}
+
+    def active_partition(self, collection: Collection) -> str:
+        """Возвращает партицию последней переиндексации или партицию по умолчанию."""
+        names = [p.name for p in collection.partitions if p.name.startswith(REINDEX_PARTITION_PREFIX)]
+        return max(names) if names else DEFAULT_PARTITION
+
+    def drop_stale_partitions(self, collection: Collection, active: str):
+        """
+        Удаляет данные всех партиций, кроме активной: партиции прошлых
+        переиндексаций удаляются целиком, партиция по умолчанию очищается.
+        """
+        for partition in collection.partitions:
+            if partition.name == active:
+                continue
+            if partition.name == DEFAULT_PARTITION:
+                if partition.num_entities:
+                    collection.delete(f"candidate_id >= {-2 ** 63}", partition_name=DEFAULT_PARTITION)
+                continue
+            self.drop_partition(collection, partition.name)
+
+    def drop_partition(self, collection: Collection, name: str):
+        logger.info(f"Dropping partition '{name}'...")
+        collection.partition(name).release()
+        collection.drop_partition(name)
+
+    def insert_vectors(self, collection: Collection, ids: Sequence[int], vectors: np.ndarray, partition_name: str = None):
+        if not len(ids):
             return None
+        if isinstance(vectors, np.ndarray):
+            assert vectors.dtype == VECTOR_NUMPY_DTYPES[VECTOR_TYPE], f"Unexpected vector dtype {vectors.dtype}"
+            assert vectors.shape == (len(ids), DIMENSION), f"Unexpected vectors shape {vectors.shape}"
+            assert vectors.flags.c_contiguous, "Vectors must be C-contiguous"
+        else:
+            assert len(vectors) == len(ids), "Vectors and ids length mismatch"
 
         try:
-            logger.info(f"Inserting {len(ids)} vectors into Milvus collection...")
-            mr = collection.insert([ids, vectors])
-            collection.flush()
-
-            try:
-                progress = utility.loading_progress(COLLECTION_NAME)
-                if progress.get('loading_progress', '0%') != '100%':
-                    logger.info(f"Collection not fully loaded ({progress['loading_progress']}). Loading now...")
-                    collection.load()
-            except MilvusException as me:
-                if me.code == 101:
-                    logger.warning("Collection not loaded yet. Loading now...")
-                    collection.load()
-                else:
-                    raise
-
-            return mr
+            logger.debug(f"Inserting {len(ids)} vectors into Milvus collection...")
+            return collection.insert([ids, vectors], partition_name=partition_name)
         except Exception as e:
             logger.error(f"Error during insert_vectors: {e}")
             raise
 
+    def finalize(self, collection: Collection):
+        """
+        Завершает массовую загрузку: один flush запечатывает сегменты,
+        compact сливает мелкие сегменты и вычищает удаленные записи.
+        """
+        collection.flush()
+        collection.compact()
+        logger.info(f"Collection '{COLLECTION_NAME}' flushed and compaction requested.")
+
 milvus_client = MilvusClient()
\ No newline at end of file
@@ -1,32 +1,152 @@
 import asyncio
 import logging
-from functools import lru_cache
-from collections import defaultdict
+import threading
+import time
+import orjson
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from collections import OrderedDict
 from elasticsearch import AsyncElasticsearch
 from sentence_transformers import SentenceTransformer
 from typing import List, Dict, Any
 
 from app.core.config import settings
+from app.ml_models import encode_in_pool
 from app.services.indexer import CANDIDATE_ALIAS
-from app.services.milvus_client import milvus_client
+from app.services.milvus_client import milvus_client, candidate_pk, get_search_params, to_milvus_vectors
 
 logger = logging.getLogger(__name__)
 RRF_K = getattr(settings, 'RRF_K', 60)
+QUERY_CACHE_SIZE = getattr(settings, 'QUERY_CACHE_SIZE', 10_000)
+QUERY_CACHE_WARMUP_SIZE = getattr(settings, 'QUERY_CACHE_WARMUP_SIZE', 100)
+SEARCH_BATCH_WINDOW = getattr(settings, 'SEARCH_BATCH_WINDOW_MS', 5) / 1000
+SEARCH_BATCH_MAX_SIZE = getattr(settings, 'SEARCH_BATCH_MAX_SIZE', 64)
+SEARCH_CACHE_SIZE = getattr(settings, 'SEARCH_CACHE_SIZE', 1024)
+SEARCH_CACHE_TTL = getattr(settings, 'SEARCH_CACHE_TTL', 60)
+MILVUS_SEARCH_TIMEOUT = getattr(settings, 'MILVUS_SEARCH_TIMEOUT', 2.0)
+ES_SEARCH_TIMEOUT = getattr(settings, 'ES_SEARCH_TIMEOUT', 2.0)
+# "es_prefilter": Milvus ранжирует только отфильтрованных Elasticsearch кандидатов;
+# "parallel": обе стороны независимо отдают по HYBRID_PARALLEL_SIZE результатов.
+HYBRID_MODE = getattr(settings, 'HYBRID_MODE', 'es_prefilter')
+ES_CANDIDATES_SIZE = getattr(settings, 'ES_CANDIDATES_SIZE', 500)
+HYBRID_PARALLEL_SIZE = getattr(settings, 'HYBRID_PARALLEL_SIZE', 50)
+SEARCH_TOP_K = getattr(settings, 'SEARCH_TOP_K', 10)
+MILVUS_EXPR_MAX_IDS = getattr(settings, 'MILVUS_EXPR_MAX_IDS', 64)
+MILVUS_GLOBAL_LIMIT = getattr(settings, 'MILVUS_GLOBAL_LIMIT', 200)
+# Неизменная часть тела поиска; на каждый запрос добавляется только query.
+ES_SEARCH_SKELETON = {
+    "size": HYBRID_PARALLEL_SIZE if HYBRID_MODE == "parallel" else ES_CANDIDATES_SIZE,
+    "_source": False,
+    "track_total_hits": False
+}
+
+
+class TTLCache:
+    """LRU-кэш с ограниченным временем жизни записей (для использования из event loop)."""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        if self.ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+
+def _cache_key(filters: dict) -> bytes:
+    return orjson.dumps(filters, option=orjson.OPT_SORT_KEYS)
+
 
 class SearchEngine:
-    def __init__(self, model: SentenceTransformer):
-        self.es_client = AsyncElasticsearch(settings.ELASTICSEARCH_URL)
+    def __init__(self, model: SentenceTransformer, es_client: AsyncElasticsearch, encode_pool: ProcessPoolExecutor = None):
+        self.es_client = es_client
+        self._search_client = es_client.options(request_timeout=ES_SEARCH_TIMEOUT)
+        self.encode_pool = encode_pool
         self.es_index_name = CANDIDATE_ALIAS
+        self._msearch_header = orjson.dumps({"index": self.es_index_name}) + b"\n"
         self.milvus_collection = milvus_client.create_collection_if_not_exists()
         self.model = model
-        self.encode_query = lru_cache(maxsize=1024)(self.model.encode)
-        self.executor = asyncio.get_event_loop().run_in_executor
+        self._query_cache = OrderedDict()
+        self._query_cache_lock = threading.Lock()
+        # Результаты гибридного поиска и отдельно выдача Elasticsearch:
+        # последняя не зависит от role и переиспользуется разными смысловыми запросами.
+        self.result_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+        self._es_cache = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
 
-    async def _filter_candidates_with_elasticsearch(self, filters: dict) -> List[Dict[str, float]]:
+    def encode_queries(self, texts: List[str]) -> List[np.ndarray]:
         """
-        Возвращает список ID кандидатов, подходящих под точные критерии.
+        Кодирует несколько запросов одним вызовом модели. Тексты нормализуются,
+        повторы схлопываются, а уже известные эмбеддинги берутся из LRU-кэша.
+        """
+        keys = [" ".join(text.lower().split()) for text in texts]
+        vectors = {}
+        with self._query_cache_lock:
+            for key in keys:
+                if key in self._query_cache:
+                    self._query_cache.move_to_end(key)
+                    vectors[key] = self._query_cache[key]
+
+        missing = [key for key in dict.fromkeys(keys) if key not in vectors]
+        if missing:
+            if self.encode_pool is not None:
+                encoded = encode_in_pool(self.encode_pool, missing)
+            else:
+                encoded = self.model.encode(missing, convert_to_numpy=True, normalize_embeddings=True)
+            encoded = np.ascontiguousarray(encoded, dtype=np.float32)
+            with self._query_cache_lock:
+                for key, vector in zip(missing, encoded):
+                    vectors[key] = vector
+                    self._query_cache[key] = vector
+                while len(self._query_cache) > QUERY_CACHE_SIZE:
+                    self._query_cache.popitem(last=False)
+
+        return [vectors[key] for key in keys]
+
+    def encode_query(self, text: str):
+        """Кодирует запрос с кэшированием по нормализованному тексту."""
+        return self.encode_queries([text])[0]
+
+    async def warm_query_cache(self, top_k: int = QUERY_CACHE_WARMUP_SIZE):
+        """
+        Заполняет кэш эмбеддингов самыми частыми должностями из индекса.
+        """
+        try:
+            response = await self.es_client.search(
+                index=self.es_index_name,
+                size=0,
+                aggs={"top_roles": {"terms": {"field": "headline_role.keyword", "size": top_k}}}
+            )
+            roles = [bucket["key"] for bucket in response["aggregations"]["top_roles"]["buckets"]]
+        except Exception as e:
+            logger.warning(f"Could not fetch top roles for query cache warm-up: {e}")
+            return
+
+        if roles:
+            await asyncio.to_thread(self.encode_queries, roles)
+        logger.info(f"Query embedding cache warmed with {len(roles)} roles.")
+
+    def _build_es_query(self, filters: dict) -> dict:
         """
-        must_queries = []
+        Собирает запрос Elasticsearch по точным критериям фильтра.
+        Точные условия идут в filter (без скоринга, кэшируются),
+        желательные навыки - в should и влияют только на порядок.
+        """
+        filter_queries = []
         should_queries = []
         must_not_queries = []
 
@@ -38,112 +158,349 @@ class SearchEngine:
             experience_range["lte"] = filters["experience_max"]
 
         if experience_range:
-            must_queries.append({"range": {"experience_years": experience_range}})
+            filter_queries.append({"range": {"experience_years": experience_range}})
 
         if filters.get("location"):
-            must_queries.append({"match": {"location": {"query": filters["location"], "fuzziness": "AUTO"}}})
+            filter_queries.append({"term": {"location": filters["location"]}})
 
         if filters.get("must_skills"):
-            for skill in filters["must_skills"]:
-                must_queries.append({"match": {"skills": {"query": skill.lower(), "fuzziness": "AUTO"}}})
+            filter_queries.append({
+                "terms_set": {
+                    "skills": {
+                        "terms": filters["must_skills"],
+                        "minimum_should_match_script": {"source": "params.num_terms"}
+                    }
+                }
+            })
         
         if filters.get("nice_skills"):
+            # Каждое совпадение добавляет фиксированный балл: BM25 для keyword-поля
+            # ничего не дает, а constant_score избавляет от его вычисления.
             for skill in filters["nice_skills"]:
-                should_queries.append({"match": {"skills": {"query": skill.lower(), "fuzziness": "AUTO"}}})
+                should_queries.append({"constant_score": {"filter": {"term": {"skills": skill}}}})
 
         if filters.get("work_modes"):
-            must_queries.append({"terms": {"work_modes": filters["work_modes"]}})
+            filter_queries.append({"terms": {"work_modes": filters["work_modes"]}})
         
         if filters.get("exclude_ids"):
             must_not_queries.append({"ids": {"values": filters["exclude_ids"]}})
 
-        es_query = {
+        return {
             "bool": {
-                "must": must_queries,
+                "filter": filter_queries,
                 "should": should_queries,
                 "must_not": must_not_queries
             }
-        } if must_queries or should_queries or must_not_queries else {"match_all": {}}
+        } if filter_queries or should_queries or must_not_queries else {"match_all": {}}
+
+    def _parse_es_hits(self, hits: list) -> List[Dict[str, float]]:
+        ranked_candidates = [
+            {"candidate_id": hit["_id"], "score": hit.get("_score") or 0}
+            for hit in hits
+        ]
+        ranked_candidates.sort(key=lambda x: x["score"], reverse=True)
+        return ranked_candidates
+
+    async def _filter_candidates_with_elasticsearch(self, filters: dict) -> List[Dict[str, float]]:
+        """
+        Возвращает список ID кандидатов, подходящих под точные критерии.
+        """
+        return (await self._filter_candidates_batch([filters]))[0]
 
+    async def _msearch(self, bodies: List[dict]) -> list:
+        """
+        Выполняет несколько поисков одним msearch. Тело сериализуется сразу
+        в NDJSON-байты; для неудачных подзапросов возвращается None.
+        """
+        body = b"".join(self._msearch_header + orjson.dumps(search) + b"\n" for search in bodies)
         try:
-            response = await self.es_client.search(
-                index=self.es_index_name,
-                query=es_query,
-                size=500,
-                _source=["id"]
-            )
-            
-            ranked_candidates = [
-                {"candidate_id": hit["_source"]["id"], "score": hit.get("_score", 0)}
-                for hit in response["hits"]["hits"]
-            ]
-            ranked_candidates.sort(key=lambda x: x["score"], reverse=True)
-            logger.info(f"Elasticsearch filtered and ranked {len(ranked_candidates)} candidates.")
-            return ranked_candidates
+            response = await self._search_client.msearch(searches=body)
         except Exception as e:
-            logger.error(f"Error during Elasticsearch filtering: {e}")
-            return []
+            logger.error(f"Error during Elasticsearch msearch: {e}")
+            return [None] * len(bodies)
+
+        results = []
+        for item in response["responses"]:
+            if "error" in item:
+                logger.error(f"Error in msearch sub-query: {item['error']}")
+                results.append(None)
+            else:
+                results.append(item["hits"]["hits"])
+        return results
 
-    def _rank_candidates_with_milvus(self, query_text: str, candidate_ids: List[str], top_k: int = 10) -> List[Dict[str, Any]]:
+    async def _filter_candidates_batch(self, filters_batch: List[dict]) -> List[List[Dict[str, float]]]:
         """
-        Ищет в Milvus среди отфильтрованных ID самые близкие по смыслу.
+        Выполняет фильтрацию для нескольких запросов одним вызовом msearch;
+        недавние результаты берутся из кэша, одинаковые фильтры запрашиваются один раз.
         """
-        if not candidate_ids or not query_text:
-            return []
-            
-        query_vector = self.encode_query(query_text)
-        
-        id_filter_expression = f"candidate_id in {candidate_ids}".replace("'", '"')
+        keys = [_cache_key({k: v for k, v in filters.items() if k != "role"}) for filters in filters_batch]
+        cached = {key: hit for key in keys if (hit := self._es_cache.get(key)) is not None}
+        pending = {}
+        for key, filters in zip(keys, filters_batch):
+            if key not in cached:
+                pending.setdefault(key, filters)
+        if not pending:
+            return [cached[key] for key in keys]
 
-        logger.info(f"Searching in Milvus among {len(candidate_ids)} candidates for query: '{query_text}'")
-        search_params = {"metric_type": "IP", "params": {"nprobe": 10}}
-        
-        results = self.milvus_collection.search(
-            data=[query_vector],
+        hits_batch = await self._msearch(
+            [{**ES_SEARCH_SKELETON, "query": self._build_es_query(filters)} for filters in pending.values()]
+        )
+        for key, hits in zip(pending, hits_batch):
+            if hits is None:
+                cached[key] = []
+            else:
+                cached[key] = self._parse_es_hits(hits)
+                self._es_cache.set(key, cached[key])
+        logger.info(f"Elasticsearch msearch filtered {len(pending)} queries.")
+        return [cached[key] for key in keys]
+
+    async def _search_milvus(self, query_vector, limit: int, expr: str = None) -> list:
+        """
+        Возвращает пары (первичный ключ, близость) из Milvus. Запрос уходит
+        асинхронным gRPC-вызовом с дедлайном MILVUS_SEARCH_TIMEOUT, поэтому
+        ожидание результата в потоке не длится дольше таймаута.
+        """
+        search_future = self.milvus_collection.search(
+            data=to_milvus_vectors([query_vector]),
             anns_field="embedding",
-            param=search_params,
-            limit=top_k,
-            expr=id_filter_expression
+            param=get_search_params(limit),
+            limit=limit,
+            expr=expr,
+            timeout=MILVUS_SEARCH_TIMEOUT,
+            _async=True
         )
-        
-        ranked_results = [{"candidate_id": hit.id, "score": hit.distance} for hit in results[0]]
+        results = await asyncio.to_thread(search_future.result)
+        return [(hit.id, hit.distance) for hit in results[0]]
+
+    async def _rank_candidates_with_milvus(self, query_vector, candidate_ids: List[str], top_k: int = SEARCH_TOP_K) -> List[Dict[str, Any]]:
+        """
+        Ищет в Milvus среди отфильтрованных ID самые близкие по смыслу.
+        """
+        if not candidate_ids or query_vector is None:
+            return []
+
+        ids_by_pk = {candidate_pk(candidate_id): candidate_id for candidate_id in candidate_ids}
+
+        hits = []
+        if len(ids_by_pk) > MILVUS_EXPR_MAX_IDS:
+            # Для большого набора ID дешевле взять глобальный top из Milvus
+            # и пересечь его с кандидатами Elasticsearch, чем вычислять expr.
+            try:
+                global_hits = await self._search_milvus(query_vector, MILVUS_GLOBAL_LIMIT)
+                hits = [(pk, distance) for pk, distance in global_hits if pk in ids_by_pk][:top_k]
+            except Exception as e:
+                logger.warning(f"Global Milvus search failed, falling back to ID filter: {e}")
+        if len(hits) < min(top_k, len(ids_by_pk)):
+            # Пересечение оказалось слишком маленьким — ищем с фильтром по ID.
+            logger.info(f"Searching in Milvus among {len(candidate_ids)} candidates.")
+            hits = await self._search_milvus(query_vector, top_k, f"candidate_id in {list(ids_by_pk)}")
+        ranked_results = [{"candidate_id": ids_by_pk[pk], "score": distance} for pk, distance in hits]
         
         logger.info(f"Milvus returned {len(ranked_results)} ranked candidates.")
         return ranked_results
 
-    async def hybrid_search(self, filters: dict) -> List[Dict[str, Any]]:
+    async def _semantic_candidates_batch(self, filters_batch: List[dict], query_vectors: list) -> List[List[Dict[str, Any]]]:
         """
-        Основной метод гибридного поиска.
+        Режим parallel: ищет ближайших кандидатов по всей коллекции Milvus,
+        затем одним msearch оставляет только подходящих под фильтры
+        (по milvus_pk), сохраняя порядок Milvus.
         """
+        hits_batch = await asyncio.gather(*(
+            self._search_milvus(query_vector, HYBRID_PARALLEL_SIZE) if query_vector is not None else asyncio.sleep(0, [])
+            for query_vector in query_vectors
+        ))
+
+        checks = [
+            (i, {
+                "size": len(hits),
+                "_source": False,
+                "track_total_hits": False,
+                "query": {"bool": {"filter": [
+                    self._build_es_query(filters_batch[i]),
+                    {"terms": {"milvus_pk": [pk for pk, _ in hits]}}
+                ]}}
+            })
+            for i, hits in enumerate(hits_batch) if hits
+        ]
+        allowed_batch = await self._msearch([body for _, body in checks]) if checks else []
+
+        results = [[] for _ in filters_batch]
+        for (i, _), allowed_hits in zip(checks, allowed_batch):
+            allowed = {candidate_pk(hit["_id"]): hit["_id"] for hit in allowed_hits or []}
+            results[i] = [
+                {"candidate_id": allowed[pk], "score": distance}
+                for pk, distance in hits_batch[i] if pk in allowed
+            ]
+        return results
+
+    def _semantic_query_text(self, filters: dict) -> str:
         semantic_parts = []
         if filters.get("role"):
             semantic_parts.append(filters["role"])
         if filters.get("nice_skills"):
             semantic_parts.extend(filters["nice_skills"])
+        return ", ".join(semantic_parts)
 
-        semantic_query_text = ", ".join(semantic_parts)
-        
-        es_results = await self._filter_candidates_with_elasticsearch(filters)
+    def _encode_filter(self, filters: dict):
+        """
+        Возвращает единственный эмбеддинг запроса, используемый на всех
+        этапах гибридного поиска, или None, если смысловой части нет.
+        """
+        return self._encode_filters([filters])[0]
+
+    def _encode_filters(self, filters_batch: List[dict]) -> list:
+        """Кодирует смысловые части нескольких фильтров одним вызовом модели."""
+        texts = [self._semantic_query_text(filters) for filters in filters_batch]
+        non_empty = [text for text in texts if text]
+        encoded = iter(self.encode_queries(non_empty) if non_empty else [])
+        return [next(encoded) if text else None for text in texts]
+
+    def _fuse_rrf(self, es_results: List[Dict[str, Any]], milvus_results: List[Dict[str, Any]], top_k: int = SEARCH_TOP_K) -> List[Dict[str, Any]]:
+        """
+        Объединяет выдачи Elasticsearch и Milvus методом RRF и возвращает top_k
+        лучших. Полная сортировка не нужна: np.partition находит порог top_k за
+        линейное время, сортируются только прошедшие его.
+        """
+        if not es_results and not milvus_results:
+            return []
+
+        ids = np.array(
+            [doc["candidate_id"] for doc in es_results] + [doc["candidate_id"] for doc in milvus_results],
+            dtype=object
+        )
+        scores = np.concatenate([
+            1.0 / (RRF_K + np.arange(1, len(es_results) + 1)),
+            1.0 / (RRF_K + np.arange(1, len(milvus_results) + 1)),
+        ])
+        unique_ids, first_seen, inverse = np.unique(ids, return_index=True, return_inverse=True)
+        fused = np.zeros(len(unique_ids))
+        np.add.at(fused, inverse, scores)
+
+        candidates = np.arange(len(fused))
+        if top_k and top_k < len(fused):
+            # Порог top_k-го значения; равные ему очки берутся все, чтобы
+            # выбор среди них решался порядком появления, а не argpartition.
+            kth = np.partition(fused, len(fused) - top_k)[len(fused) - top_k]
+            candidates = np.flatnonzero(fused >= kth)
+        # np.unique сортирует по ID, поэтому равные очки упорядочиваются по первому
+        # появлению в выдачах (сначала Elasticsearch), как в исходной реализации.
+        order = candidates[np.lexsort((first_seen[candidates], -fused[candidates]))][:top_k or None]
+        return [{"candidate_id": unique_ids[i], "score": float(fused[i])} for i in order]
+
+    async def _rank_and_fuse(self, es_results: List[Dict[str, Any]], query_vector) -> List[Dict[str, Any]]:
         if not es_results:
             return []
 
         filtered_ids = [res['candidate_id'] for res in es_results]
 
-        milvus_results = await asyncio.get_event_loop().run_in_executor(
-            None, self._rank_candidates_with_milvus, semantic_query_text, filtered_ids
+        milvus_results = await self._rank_candidates_with_milvus(query_vector, filtered_ids, top_k=SEARCH_TOP_K)
+        return self._fuse_rrf(es_results, milvus_results)
+
+    async def search_batch(self, filters_batch: List[dict]) -> list:
+        """
+        Гибридный поиск для пакета запросов. Для каждого запроса возвращает
+        список результатов или исключение.
+        """
+        es_task = asyncio.create_task(self._filter_candidates_batch(filters_batch))
+        try:
+            query_vectors = await asyncio.to_thread(self._encode_filters, filters_batch)
+            if HYBRID_MODE == "parallel":
+                milvus_batch = await self._semantic_candidates_batch(filters_batch, query_vectors)
+                es_results_batch = await es_task
+                return [
+                    self._fuse_rrf(es_results, milvus_results)
+                    for es_results, milvus_results in zip(es_results_batch, milvus_batch)
+                ]
+
+            es_results_batch = await es_task
+        except BaseException:
+            es_task.cancel()
+            raise
+        return await asyncio.gather(
+            *(self._rank_and_fuse(es_results, query_vector)
+              for es_results, query_vector in zip(es_results_batch, query_vectors)),
+            return_exceptions=True
         )
 
-        rrf_scores = defaultdict(float)
-        for rank, doc in enumerate(es_results):
-            rrf_scores[doc['candidate_id']] += 1 / (RRF_K + rank + 1)
+    async def hybrid_search(self, filters: dict) -> List[Dict[str, Any]]:
+        """
+        Основной метод гибридного поиска.
+        """
+        key = _cache_key(filters)
+        if (cached := self.result_cache.get(key)) is not None:
+            return cached
+        results = (await self.search_batch([filters]))[0]
+        if isinstance(results, Exception):
+            raise results
+        if results:
+            # Пустая выдача не кэшируется: она может быть следствием ошибки Elasticsearch.
+            self.result_cache.set(key, results)
+        return results
 
-        for rank, doc in enumerate(milvus_results):
-            rrf_scores[doc["candidate_id"]] += 1 / (RRF_K + rank + 1)
 
-        if not rrf_scores:
-            return []
-            
-        final_results = [{"candidate_id": doc_id, "score": score} for doc_id, score in rrf_scores.items()]
-        final_results.sort(key=lambda x: x['score'], reverse=True)
+class BatchedSearcher:
+    """
+    Объединяет конкурентные запросы гибридного поиска: запросы, пришедшие
+    в пределах короткого окна, уходят в Elasticsearch одним msearch,
+    а их смысловые части кодируются моделью одним пакетом.
+    Поиск в Milvus выполняется по каждому запросу отдельно, но параллельно.
+    """
+    def __init__(self, engine: SearchEngine, window: float = SEARCH_BATCH_WINDOW, max_batch_size: int = SEARCH_BATCH_MAX_SIZE):
+        self.engine = engine
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._queue = None
+        self._task = None
+        self._pending = set()
+
+    async def hybrid_search(self, filters: dict) -> List[Dict[str, Any]]:
+        key = _cache_key(filters)
+        if (cached := self.engine.result_cache.get(key)) is not None:
+            return cached
+
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._collect())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((filters, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = asyncio.create_task(self._process(batch))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+
+    async def _process(self, batch: list):
+        filters_batch = [filters for filters, _ in batch]
+        try:
+            results = await self.engine.search_batch(filters_batch)
+        except Exception as e:
+            results = [e] * len(batch)
+
+        for (filters, future), result in zip(batch, results):
+            if not isinstance(result, Exception) and result:
+                self.engine.result_cache.set(_cache_key(filters), result)
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
 
-        return final_results
+    async def close(self):
+        if self._task and not self._task.done():
+            self._task.cancel()